@@ -2,9 +2,10 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager # Import LoginManager
 from flask_migrate import Migrate # Import Migrate
+from werkzeug.middleware.proxy_fix import ProxyFix
 from config import ActiveConfig
 from .database import db # Import db instance from database.py
-from .services import close_geoip
+from .services import close_geoip, configure_geoip, pixel_shedder
 import logging
 import atexit
 import sqlalchemy.exc
@@ -48,6 +49,12 @@ def create_app(config_object=ActiveConfig):
          app.logger.warning(f"GeoIP database file may be missing at: {geoip_path}")
 
 
+    # Trust X-Forwarded-For only for the configured number of proxy hops
+    proxy_hops = app.config.get('PROXY_FIX_X_FOR', 0)
+    if proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops)
+        app.logger.info(f"ProxyFix enabled for {proxy_hops} trusted X-Forwarded-For hop(s).")
+
     # Initialize extensions with app
     db.init_app(app)
     login_manager.init_app(app)
@@ -85,6 +92,13 @@ def create_app(config_object=ActiveConfig):
     except Exception as e:
         app.logger.error(f"Failed to register main blueprint: {e}", exc_info=True)
 
+    # Open the memory-mapped GeoIP reader up front (shared with workers under gunicorn --preload)
+    if configure_geoip(app):
+        app.logger.info(f"GeoIP reader ready; reload check every {app.config.get('GEOIP_RELOAD_INTERVAL')}s.")
+
+    pixel_shedder.configure(app.config)
+    app.logger.info("Tracking pixel load shedding configured.")
+
     # Register atexit cleanup
     atexit.register(close_geoip)
     app.logger.info("Registered GeoIP reader cleanup function via atexit.")
@@ -123,4 +137,32 @@ def create_app(config_object=ActiveConfig):
              db.session.rollback()
              print(f"Error creating user: {e}")
 
+    @app.cli.command('index-subjects')
+    def index_subjects_command():
+        """Rebuilds the subject search index for all sent emails (idempotent, safe to re-run)."""
+        from .models import SentEmail, SentEmailTerm
+        batch_size = 1000
+        indexed = 0
+        last_id = 0
+        try:
+            while True:
+                batch = SentEmail.query.filter(SentEmail.id > last_id)\
+                                       .order_by(SentEmail.id.asc()).limit(batch_size).all()
+                if not batch:
+                    break
+                # Replace each batch's terms in one transaction so searches never see it half-indexed
+                SentEmailTerm.query.filter(SentEmailTerm.sent_email_id.in_([e.id for e in batch]))\
+                                   .delete(synchronize_session=False)
+                for sent_email in batch:
+                    db.session.add_all(sent_email.build_subject_terms())
+                db.session.commit()
+                indexed += len(batch)
+                last_id = batch[-1].id
+            print(f"Indexed subjects for {indexed} sent emails.")
+        except Exception as e:
+             db.session.rollback()
+             print(f"Error indexing subjects after sent email ID {last_id} ({indexed} indexed): {e}")
+             print("Earlier batches were committed; fix the error and re-run the command.")
+             raise SystemExit(1)
+
     return app
\ No newline at end of file
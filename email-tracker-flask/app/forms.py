@@ -12,4 +12,12 @@ class ComposeEmailForm(FlaskForm):
     recipient = StringField('Recipient Email', validators=[DataRequired(), Email()])
     subject = StringField('Subject', validators=[DataRequired(), Length(max=255)])
     body_html = TextAreaField('Email Body (HTML Allowed)', validators=[DataRequired()])
-    submit = SubmitField('Send Tracked Email')
\ No newline at end of file
+    submit = SubmitField('Send Tracked Email')
+
+class SearchEmailsForm(FlaskForm):
+    class Meta:
+        csrf = False # Read-only GET form
+
+    recipient = StringField('Recipient starts with', validators=[Optional(), Length(max=255)])
+    subject = StringField('Subject contains all words', validators=[Optional(), Length(max=255)])
+    submit = SubmitField('Search')
\ No newline at end of file
@@ -1,6 +1,8 @@
 from .database import db
 from datetime import datetime
 import uuid
+import re
+import unicodedata
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin # Import UserMixin
 
@@ -12,6 +14,9 @@ class User(UserMixin, db.Model): # Inherit from UserMixin
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False, index=True)
     password_hash = db.Column(db.String(128)) # Store hash, not password
+    # Bumped on every send/open by this user; drives the dashboard's conditional GET validator
+    activity_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_activity = db.Column(db.DateTime, nullable=True)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -25,6 +30,13 @@ class User(UserMixin, db.Model): # Inherit from UserMixin
 # SentEmail and EmailOpen models remain the same as before
 class SentEmail(db.Model):
     __tablename__ = 'sent_emails'
+    __table_args__ = (
+        # Newest-first listing and keyset pagination per user
+        db.Index('ix_sent_emails_sender_send_time', 'sender_user_id', 'send_time', 'id'),
+        # Recipient prefix search (prefix length keeps utf8mb4 keys within InnoDB limits)
+        db.Index('ix_sent_emails_sender_recipient', 'sender_user_id', 'recipient_email',
+                 mysql_length={'recipient_email': 191}),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     tracking_id = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()), index=True)
@@ -39,6 +51,15 @@ class SentEmail(db.Model):
     recipient_email = db.Column(db.String(255), nullable=True)
 
     opens = db.relationship('EmailOpen', backref='sent_email', lazy='dynamic', cascade="all, delete-orphan")
+    subject_terms = db.relationship('SentEmailTerm', lazy='dynamic', cascade="all, delete-orphan")
+
+    def build_subject_terms(self):
+        """Returns index rows for this email's subject words (must be flushed so id/send_time are set)."""
+        if self.sender_user_id is None:
+            return [] # Only user-owned emails are searchable
+        return [SentEmailTerm(sender_user_id=self.sender_user_id, term=term,
+                              send_time=self.send_time, sent_email_id=self.id)
+                for term in tokenize_subject(self.subject)]
 
     def __repr__(self):
         return f'<SentEmail {self.tracking_id}>'
@@ -54,4 +75,37 @@ class EmailOpen(db.Model):
     user_agent = db.Column(db.String(255), nullable=True)
 
     def __repr__(self):
-        return f'<EmailOpen ID: {self.id} for SentEmail ID: {self.sent_email_id}>'
\ No newline at end of file
+        return f'<EmailOpen ID: {self.id} for SentEmail ID: {self.sent_email_id}>'
+
+SUBJECT_TERM_MAX_LENGTH = 64
+SUBJECT_TERM_MIN_LENGTH = 2
+
+def normalize_term(word):
+    """Folds case and strips accents so e.g. 'Résumé'/'resume' and 'Straße'/'strasse' index alike."""
+    decomposed = unicodedata.normalize('NFKD', word.casefold())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+def tokenize_subject(text):
+    """Splits a subject (or search text) into distinct normalized words, in order of appearance."""
+    terms = []
+    for word in re.findall(r'\w+', text or ''):
+        word = normalize_term(word)[:SUBJECT_TERM_MAX_LENGTH]
+        if len(word) >= SUBJECT_TERM_MIN_LENGTH and word not in terms:
+            terms.append(word)
+    return terms
+
+class SentEmailTerm(db.Model):
+    """
+    Per-user inverted index of subject words. The primary key lets a word search
+    read one user's matches for a term already in (send_time, id) order.
+    """
+    __tablename__ = 'sent_email_terms'
+
+    sender_user_id = db.Column(db.Integer, primary_key=True)
+    # Binary collation: terms are already normalized, and exact comparison keeps distinct terms distinct keys
+    term = db.Column(db.String(SUBJECT_TERM_MAX_LENGTH, collation='utf8mb4_bin'), primary_key=True)
+    send_time = db.Column(db.DateTime, primary_key=True)
+    sent_email_id = db.Column(db.Integer, db.ForeignKey('sent_emails.id', ondelete='CASCADE'), primary_key=True, index=True)
+
+    def __repr__(self):
+        return f'<SentEmailTerm {self.term!r} for SentEmail ID: {self.sent_email_id}>'
\ No newline at end of file
@@ -1,22 +1,27 @@
 from flask import (
     Blueprint, request, jsonify, send_from_directory,
     render_template, abort, current_app, url_for, Response,
-    flash, redirect # Added flash and redirect
+    flash, redirect, session, make_response
 )
 from flask_login import login_user, logout_user, login_required, current_user # Added Flask-Login functions
+from sqlalchemy import func, and_, or_, exists
+from sqlalchemy.orm import aliased
 from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.http import is_resource_modified
 from urllib.parse import urlparse, urljoin # For safe redirects
 
 import uuid
 import os
+import hashlib
+from datetime import datetime, timezone
 import logging
 import smtplib # For sending email
 from email.message import EmailMessage # For constructing email
 
-from .models import SentEmail, EmailOpen, User # Added User
+from .models import SentEmail, EmailOpen, User, SentEmailTerm, tokenize_subject # Added User
 from .database import db
-from .services import get_client_ip, get_location_from_ip # get_client_ip now used less directly
-from .forms import LoginForm, ComposeEmailForm # Added forms
+from .services import get_client_ip, get_location_from_ip, pixel_shedder # get_client_ip now used less directly
+from .forms import LoginForm, ComposeEmailForm, SearchEmailsForm # Added forms
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +30,8 @@ main_bp = Blueprint('main', __name__,
                     static_folder='static')
 
 PIXEL_FILENAME = 'pixel.gif'
+SEARCH_PER_PAGE = 15
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
 
 # --- Helper Functions ---
 
@@ -34,6 +41,82 @@ def is_safe_url(target):
     test_url = urlparse(urljoin(request.host_url, target))
     return test_url.scheme in ('http', 'https') and ref_url.netloc == test_url.netloc
 
+def build_validator(*parts, last_modified=None):
+    """Builds an (etag, last_modified) pair from cheap, already-queried values."""
+    etag = hashlib.sha1(":".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    if last_modified is not None:
+        # Stored timestamps are naive UTC; HTTP dates have second precision
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+    return etag, last_modified
+
+def not_modified_response(etag, last_modified=None):
+    """
+    Returns a 304 response if the client's cached copy is still current, else None.
+    Skipped while flashed messages are pending so they are not left unrendered.
+    """
+    if session.get('_flashes'):
+        return None
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return apply_validator(Response(status=304), etag, last_modified)
+
+def apply_validator(response, etag, last_modified=None):
+    """Attaches validator headers so the browser revalidates on every view."""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+def dashboard_validator(user, page):
+    """Computes the dashboard validator from the user's activity high-water mark (no extra query)."""
+    return build_validator('dashboard', user.id, page, user.activity_seq,
+                           last_modified=user.last_activity)
+
+def bump_user_activity(user_id):
+    """
+    Advances a user's activity high-water mark in the current transaction; caller commits.
+    Call before inserting rows that reference the user so the exclusive row lock is taken
+    first (an FK check's shared lock followed by this update can deadlock).
+    """
+    if user_id is None:
+        return
+    db.session.execute(
+        db.update(User).where(User.id == user_id)
+          .values(activity_seq=User.activity_seq + 1, last_activity=datetime.utcnow())
+    )
+
+def report_validator(sent_email):
+    """Computes the report validator from the email's open count and latest open."""
+    # Covered by ix_email_opens_sent_email_id (InnoDB secondary indexes carry the PK)
+    open_count, last_open_id = db.session.query(
+        func.count(EmailOpen.id), func.max(EmailOpen.id)
+    ).filter(EmailOpen.sent_email_id == sent_email.id).one()
+
+    last_modified = sent_email.send_time
+    if last_open_id is not None:
+        last_modified = db.session.query(EmailOpen.open_time).filter(EmailOpen.id == last_open_id).scalar()
+    return build_validator('report', sent_email.id, current_user.id, open_count, last_open_id,
+                           last_modified=last_modified)
+
+def keyset_after(time_col, id_col, position):
+    """Rows strictly after (send_time, id) in newest-first order, written out so it maps onto a range scan."""
+    send_time, row_id = position
+    return or_(time_col < send_time, and_(time_col == send_time, id_col < row_id))
+
+def encode_search_cursor(email):
+    """Encodes the (send_time, id) keyset position of the last row shown."""
+    return f"{email.send_time.strftime(CURSOR_TIME_FORMAT)}.{email.id}"
+
+def decode_search_cursor(cursor):
+    """Parses a cursor from encode_search_cursor. Returns (send_time, id) or None if invalid."""
+    try:
+        time_part, id_part = cursor.split('.', 1)
+        return datetime.strptime(time_part, CURSOR_TIME_FORMAT), int(id_part)
+    except (ValueError, AttributeError):
+        return None
+
 def send_email_smtp(recipient, subject, html_body):
     """Sends email using configured SMTP settings."""
     sender = current_app.config['SMTP_USERNAME']
@@ -94,7 +177,11 @@ def log_send_event_internal(subject, recipient_email, sender_ip=None):
         sender_user=current_user if current_user.is_authenticated else None # Link to logged-in user
     )
     try:
+        if current_user.is_authenticated:
+            bump_user_activity(current_user.id) # Before the insert; see bump_user_activity
         db.session.add(new_email)
+        db.session.flush() # Assigns id/send_time for the subject index rows
+        db.session.add_all(new_email.build_subject_terms())
         db.session.commit()
         logger.info(f"Logged internal send for tracking_id: {new_email.tracking_id} by user {current_user.username if current_user.is_authenticated else 'Anonymous/API'}")
         # Generate URLs (need request context or app context + SERVER_NAME config)
@@ -150,11 +237,75 @@ def dashboard():
     # Add pagination for large numbers of emails
     page = request.args.get('page', 1, type=int)
     per_page = 15 # Number of emails per page
+
+    # Answer conditional requests before running the page query and rendering
+    etag, last_modified = dashboard_validator(current_user, page)
+    cached = not_modified_response(etag, last_modified)
+    if cached is not None:
+        return cached
+
     user_emails = SentEmail.query.filter_by(sender_user_id=current_user.id)\
                                  .order_by(SentEmail.send_time.desc())\
                                  .paginate(page=page, per_page=per_page, error_out=False)
 
-    return render_template('dashboard.html', title='Dashboard', emails_pagination=user_emails)
+    response = make_response(
+        render_template('dashboard.html', title='Dashboard', emails_pagination=user_emails))
+    return apply_validator(response, etag, last_modified)
+
+
+@main_bp.route('/search')
+@login_required
+def search_emails():
+    """Searches the user's sent emails by recipient prefix and/or subject words, newest first."""
+    form = SearchEmailsForm(formdata=request.args)
+    recipient = (form.recipient.data or '').strip()
+    subject = (form.subject.data or '').strip()
+    searched = bool(recipient or subject) and form.validate()
+    emails, next_cursor = [], None
+
+    if searched:
+        user_id = current_user.id
+        terms = tokenize_subject(subject)
+        if terms:
+            # Drive from the per-user term index (longest word is likely the most selective);
+            # every other word must also be indexed for the same email.
+            terms.sort(key=len, reverse=True)
+            query = SentEmail.query.join(SentEmailTerm, SentEmailTerm.sent_email_id == SentEmail.id)\
+                                   .filter(SentEmailTerm.sender_user_id == user_id,
+                                           SentEmailTerm.term == terms[0])
+            for term in terms[1:]:
+                other = aliased(SentEmailTerm)
+                query = query.filter(exists().where(
+                    other.sender_user_id == user_id, other.term == term,
+                    other.send_time == SentEmailTerm.send_time,
+                    other.sent_email_id == SentEmailTerm.sent_email_id))
+            order_time, order_id = SentEmailTerm.send_time, SentEmailTerm.sent_email_id
+        else:
+            query = SentEmail.query.filter(SentEmail.sender_user_id == user_id)
+            if subject:
+                # No indexable words (e.g. only punctuation); substring match over the user's emails
+                query = query.filter(SentEmail.subject.contains(subject, autoescape=True))
+            order_time, order_id = SentEmail.send_time, SentEmail.id
+        if recipient:
+            query = query.filter(SentEmail.recipient_email.startswith(recipient, autoescape=True))
+
+        # Keyset pagination: continue strictly after the last (send_time, id) shown
+        cursor = request.args.get('after')
+        if cursor:
+            position = decode_search_cursor(cursor)
+            if position is None:
+                abort(400, description="Invalid search cursor.")
+            query = query.filter(keyset_after(order_time, order_id, position))
+
+        rows = query.order_by(order_time.desc(), order_id.desc())\
+                    .limit(SEARCH_PER_PAGE + 1).all()
+        emails = rows[:SEARCH_PER_PAGE]
+        if len(rows) > SEARCH_PER_PAGE:
+            next_cursor = encode_search_cursor(emails[-1])
+        logger.debug(f"Search by user {current_user.username} returned {len(emails)} emails (more: {next_cursor is not None}).")
+
+    return render_template('search.html', title='Search Sent Emails', form=form, searched=searched,
+                           emails=emails, next_cursor=next_cursor, recipient=recipient, subject=subject)
 
 
 @main_bp.route('/compose', methods=['GET', 'POST'])
@@ -230,11 +381,19 @@ def view_report(tracking_id_str):
         logger.warning(f"Report tracking ID {tracking_id_str} not found or access denied for user {current_user.username}.")
         abort(404, description="Tracking ID not found or not accessible.")
 
+    # Answer conditional requests before loading every open and rendering
+    etag, last_modified = report_validator(sent_email)
+    cached = not_modified_response(etag, last_modified)
+    if cached is not None:
+        return cached
+
     email_opens = sent_email.opens.order_by(EmailOpen.open_time.asc()).all()
     total_opens = len(email_opens)
 
     logger.debug(f"Generating report for tracking_id: {tracking_id_str} with {total_opens} opens for user {current_user.username}.")
-    return render_template('report.html', title=f'Report: {sent_email.subject or sent_email.tracking_id}', email=sent_email, opens=email_opens, total_opens=total_opens)
+    response = make_response(
+        render_template('report.html', title=f'Report: {sent_email.subject or sent_email.tracking_id}', email=sent_email, opens=email_opens, total_opens=total_opens))
+    return apply_validator(response, etag, last_modified)
 
 
 # --- Tracking Pixel Endpoint (Remains Public) ---
@@ -250,14 +409,33 @@ def track_open(tracking_id_str):
         logger.warning(f"Invalid tracking ID format received: {tracking_id_str}")
         return serve_tracking_pixel() # Serve pixel anyway
 
-    # Find the original SentEmail record
-    sent_email = db.session.query(SentEmail).filter_by(tracking_id=tracking_id_query_str).first()
+    # Shed load before touching the DB; the pixel is served either way.
+    # Key on remote_addr (rewritten by ProxyFix from trusted hops only) so clients
+    # cannot dodge the per-IP bucket by rotating X-Forwarded-For.
+    if pixel_shedder.admit(request.remote_addr) is not None:
+        return serve_tracking_pixel()
+
+    opener_ip = get_client_ip()
+
+    with pixel_shedder.recording():
+        record_open(tracking_id_str, tracking_id_query_str, opener_ip)
+    return serve_tracking_pixel() # Always serve pixel
+
+
+def record_open(tracking_id_str, tracking_id_query_str, opener_ip):
+    """Looks up the SentEmail for a tracking ID and logs an open event against it."""
+    try:
+        # Find the original SentEmail record
+        sent_email = db.session.query(SentEmail).filter_by(tracking_id=tracking_id_query_str).first()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Database error looking up tracking_id {tracking_id_str}: {e}", exc_info=True)
+        return
 
     if not sent_email:
         logger.warning(f"Tracking ID not found in database: {tracking_id_str}")
-        return serve_tracking_pixel() # Serve pixel anyway
+        return
 
-    opener_ip = get_client_ip()
     opener_location = get_location_from_ip(opener_ip)
     user_agent = request.headers.get('User-Agent', 'Unknown')[:255]
 
@@ -268,14 +446,13 @@ def track_open(tracking_id_str):
         user_agent=user_agent
     )
     try:
+        bump_user_activity(sent_email.sender_user_id) # Before the insert; see bump_user_activity
         db.session.add(new_open)
         db.session.commit()
         logger.info(f"Logged open for tracking_id: {tracking_id_str} from IP: {opener_ip}")
     except Exception as e:
         db.session.rollback()
         logger.error(f"Database error logging open for {tracking_id_str}: {e}", exc_info=True)
-    finally:
-        return serve_tracking_pixel() # Always serve pixel
 
 
 def serve_tracking_pixel():
@@ -299,6 +476,13 @@ def serve_tracking_pixel():
         return Response("Error serving tracking pixel.", status=500)
 
 
+@main_bp.route('/api/pixel/stats')
+@login_required
+def pixel_stats_api():
+    """Reports this worker's pixel load-shedding state and dropped-open counters."""
+    return jsonify(pixel_shedder.stats())
+
+
 # --- Optional API Endpoint (Keep or Remove) ---
 # If you want external systems to still be able to log sends, keep this.
 # Consider adding API Key authentication here if kept.
@@ -1,76 +1,112 @@
 import geoip2.database
 import logging
 import os
-from flask import current_app, request # Import request to use it here
+import random
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_app_context, request # Import request to use it here
 from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
 # --- GeoIP Handling ---
+# The reader is memory-mapped so its pages live in the OS page cache and are shared
+# by every gunicorn worker. Replaced .mmdb files are picked up by a throttled stat()
+# check; superseded readers are dropped rather than closed so lookups already
+# holding a reference finish safely, and the mapping is released once unreferenced.
+_geoip_lock = threading.Lock()
 _geoip_reader = None
 _geoip_db_path = None
+_geoip_file_id = None # (inode, mtime, size) of the file the reader was opened from
+_geoip_reload_interval = 60.0
+_geoip_next_check = 0.0
 
-def _initialize_geoip_reader():
-    """Initializes or re-initializes the GeoIP reader using Flask app config."""
-    global _geoip_reader, _geoip_db_path
+def configure_geoip(app):
+    """Records GeoIP settings from app config and opens the reader eagerly."""
+    global _geoip_db_path, _geoip_reload_interval, _geoip_next_check
+    path = app.config.get('GEOIP_DATABASE_PATH')
+    with _geoip_lock:
+        _geoip_db_path = str(path) if path else None
+        _geoip_reload_interval = float(app.config.get('GEOIP_RELOAD_INTERVAL', 60))
+        _geoip_next_check = 0.0 # Force a check on the next call
+    return _initialize_geoip_reader() is not None
 
-    # Ensure we have an app context
-    if not current_app:
-        logger.error("Attempted to initialize GeoIP reader outside of Flask app context.")
-        return False
+def _geoip_file_identity(path):
+    """Cheap identity of the database file; changes when the file is replaced."""
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
+def _open_geoip_reader(path):
+    """Opens a memory-mapped reader, preferring maxminddb's C extension."""
     try:
-        current_path = current_app.config.get('GEOIP_DATABASE_PATH')
-    except KeyError:
-         logger.error("GEOIP_DATABASE_PATH not found in Flask config.")
-         return False
-
-    if not current_path:
-        logger.error("GEOIP_DATABASE_PATH is configured but empty in Flask config.")
-        if _geoip_reader: _geoip_reader.close()
-        _geoip_reader = None
-        _geoip_db_path = None
-        return False
-
-    # Check if path exists
-    db_path_str = str(current_path) # Ensure it's a string
-    if not os.path.exists(db_path_str):
-        # This warning now comes from config.py, log error here if needed during use
-        # logger.error(f"GeoIP database not found at configured path: {db_path_str}")
-        if _geoip_reader: _geoip_reader.close()
-        _geoip_reader = None
-        _geoip_db_path = None
-        return False
-
-    # Load only if not loaded or if path has changed
-    if _geoip_reader is None or _geoip_db_path != db_path_str:
+        return geoip2.database.Reader(path, mode=geoip2.database.MODE_MMAP_EXT)
+    except (ImportError, ValueError):
+        logger.info("maxminddb C extension unavailable, using pure-Python mmap reader.")
+        return geoip2.database.Reader(path, mode=geoip2.database.MODE_MMAP)
+
+def _initialize_geoip_reader():
+    """
+    Returns the current GeoIP reader, reopening it if the database file changed.
+    The file is only stat()ed once per GEOIP_RELOAD_INTERVAL; other calls return
+    the cached reader without locking. Safe to call from any thread.
+    """
+    global _geoip_reader, _geoip_db_path, _geoip_file_id, _geoip_next_check
+
+    now = time.monotonic()
+    if now < _geoip_next_check:
+        return _geoip_reader
+
+    with _geoip_lock:
+        if now < _geoip_next_check: # Another thread checked while we waited
+            return _geoip_reader
+        _geoip_next_check = now + _geoip_reload_interval
+
+        # Fall back to app config if configure_geoip() was never called
+        if _geoip_db_path is None and has_app_context():
+            path = current_app.config.get('GEOIP_DATABASE_PATH')
+            _geoip_db_path = str(path) if path else None
+
+        if not _geoip_db_path:
+            logger.error("GEOIP_DATABASE_PATH is not configured.")
+            _geoip_reader = None
+            _geoip_file_id = None
+            return None
+
         try:
-            if _geoip_reader: # Close previous reader if path changed
-                logger.info("GeoIP path changed, closing existing reader.")
-                _geoip_reader.close()
-            logger.info(f"Attempting to load GeoIP database from: {db_path_str}")
-            _geoip_reader = geoip2.database.Reader(db_path_str)
-            _geoip_db_path = db_path_str
-            logger.info(f"GeoIP database loaded successfully.")
-            return True
+            file_id = _geoip_file_identity(_geoip_db_path)
+        except OSError:
+            # File may be mid-replace; keep serving from the current reader (if any) and retry next check
+            logger.debug(f"GeoIP database not found at configured path: {_geoip_db_path}")
+            return _geoip_reader
+
+        if _geoip_reader is not None and file_id == _geoip_file_id:
+            return _geoip_reader # Unchanged since last load
+
+        try:
+            logger.info(f"Attempting to load GeoIP database from: {_geoip_db_path}")
+            new_reader = _open_geoip_reader(_geoip_db_path)
         except Exception as e:
-            logger.error(f"Error loading GeoIP database from {db_path_str}: {e}", exc_info=True)
-            if _geoip_reader: _geoip_reader.close()
-            _geoip_reader = None
-            _geoip_db_path = None
-            return False
-    return True # Already loaded and path is the same
+            # Keep serving from the previous reader (if any) and retry on the next check
+            logger.error(f"Error loading GeoIP database from {_geoip_db_path}: {e}", exc_info=True)
+            return _geoip_reader
+
+        if _geoip_reader is not None:
+            logger.info("GeoIP database file changed, swapping in reloaded reader.")
+        _geoip_reader = new_reader
+        _geoip_file_id = file_id
+        logger.info("GeoIP database loaded successfully.")
+        return _geoip_reader
 
 @contextmanager
 def geoip_reader_manager():
     """Context manager for safe access to the GeoIP reader."""
-    if _initialize_geoip_reader() and _geoip_reader:
-        yield _geoip_reader
-    else:
-        yield None # Indicate reader is unavailable
+    # Hold a local reference so a concurrent reload cannot pull it out from under us
+    reader = _initialize_geoip_reader()
+    yield reader # None indicates reader is unavailable
 
 def get_location_from_ip(ip_address):
-    """Looks up location for an IP address."""
+    """Looks up location for an IP address. Safe to call from worker threads without an app context."""
     if not ip_address:
         return "N/A (No IP)"
 
@@ -102,15 +138,17 @@ def get_location_from_ip(ip_address):
 
 def close_geoip():
     """Function to explicitly close the GeoIP reader, usually called via atexit."""
-    global _geoip_reader, _geoip_db_path
-    if _geoip_reader:
-        try:
-             _geoip_reader.close()
-             _geoip_reader = None
-             _geoip_db_path = None
-             logger.info("GeoIP reader closed via atexit.")
-        except Exception as e:
-             logger.error(f"Error closing GeoIP reader via atexit: {e}")
+    global _geoip_reader, _geoip_file_id
+    with _geoip_lock:
+        if _geoip_reader:
+            try:
+                 _geoip_reader.close()
+                 logger.info("GeoIP reader closed via atexit.")
+            except Exception as e:
+                 logger.error(f"Error closing GeoIP reader via atexit: {e}")
+            finally:
+                 _geoip_reader = None
+                 _geoip_file_id = None
 
 # --- IP Address Handling ---
 def get_client_ip():
@@ -127,4 +165,131 @@ def get_client_ip():
         # Fallback to remote_addr if header not present
         ip = request.remote_addr
         logger.debug(f"IP found in remote_addr: {ip}")
-    return ip
\ No newline at end of file
+    return ip
+
+
+# --- Tracking Pixel Load Shedding ---
+class TokenBucket:
+    """Classic token bucket; callers must hold their own lock."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = now
+
+    def has_token(self, now):
+        """Refills for elapsed time and reports whether a token is available, without taking it."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self):
+        """Takes one token; only call after has_token() returned True."""
+        self.tokens -= 1
+
+
+class PixelLoadShedder:
+    """
+    Decides whether a pixel hit should be recorded. The pixel itself is always served;
+    hits over the per-IP or global rate, or not sampled while the recording path is
+    overloaded (too many in flight or average latency too high), are dropped and counted.
+    State is per process, so effective limits scale with the number of workers.
+
+    The in-flight trigger only fires with threaded/gevent workers; a sync worker never
+    has another recording in progress, so there latency is the only overload signal.
+    Callers must key admit() on a proxy-trusted address, not a raw X-Forwarded-For value.
+    """
+
+    LATENCY_SMOOTHING = 0.2 # Weight of the newest sample in the latency moving average
+    PROBE_INTERVAL = 1.0 # Seconds; while overloaded, always let one recording through this often
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure({})
+
+    def configure(self, config):
+        """Reads limits from a Flask config mapping and resets all state."""
+        now = time.monotonic()
+        with self._lock:
+            self.ip_rate = float(config.get('PIXEL_IP_RATE', 5))
+            self.ip_burst = float(config.get('PIXEL_IP_BURST', 50))
+            self.max_tracked_ips = int(config.get('PIXEL_TRACKED_IPS', 10000))
+            self.max_in_flight = int(config.get('PIXEL_MAX_IN_FLIGHT', 2))
+            self.latency_threshold_ms = float(config.get('PIXEL_LATENCY_THRESHOLD_MS', 250))
+            self.sample_rate = float(config.get('PIXEL_OVERLOAD_SAMPLE_RATE', 0.1))
+            self._global_bucket = TokenBucket(float(config.get('PIXEL_GLOBAL_RATE', 200)),
+                                              float(config.get('PIXEL_GLOBAL_BURST', 400)), now)
+            self._ip_buckets = OrderedDict() # LRU so scanners cannot grow it without bound
+            self._in_flight = 0
+            self._latency_ms = 0.0
+            self._last_recorded = 0.0
+            self.dropped = {'ip_limit': 0, 'global_limit': 0, 'overload': 0}
+
+    def is_overloaded(self):
+        if self.max_in_flight and self._in_flight >= self.max_in_flight:
+            return True
+        return self._latency_ms >= self.latency_threshold_ms
+
+    def admit(self, ip):
+        """Returns None if the hit should be recorded, else the reason it was dropped."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._ip_buckets.get(ip)
+            if bucket is None:
+                bucket = TokenBucket(self.ip_rate, self.ip_burst, now)
+                self._ip_buckets[ip] = bucket
+                if len(self._ip_buckets) > self.max_tracked_ips:
+                    self._ip_buckets.popitem(last=False)
+            else:
+                self._ip_buckets.move_to_end(ip)
+
+            # Tokens are only spent on hits that will actually be recorded, so shedding
+            # (or one bucket refusing) does not drain the other limits
+            if self.is_overloaded() and now - self._last_recorded < self.PROBE_INTERVAL \
+                    and random.random() >= self.sample_rate:
+                return self._drop('overload', ip)
+            if not bucket.has_token(now):
+                return self._drop('ip_limit', ip)
+            if not self._global_bucket.has_token(now):
+                return self._drop('global_limit', ip)
+            bucket.take()
+            self._global_bucket.take()
+            self._last_recorded = now
+        return None
+
+    def _drop(self, reason, ip):
+        """Counts a dropped hit; logs the first one and then every 1000th per reason."""
+        self.dropped[reason] += 1
+        count = self.dropped[reason]
+        if count % 1000 == 1:
+            logger.warning(f"Pixel open not recorded ({reason}) for IP {ip}; {count} dropped for this reason so far.")
+        return reason
+
+    @contextmanager
+    def recording(self):
+        """Wraps the DB work for one open so in-flight count and latency can be tracked."""
+        with self._lock:
+            self._in_flight += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.monotonic() - start) * 1000
+            with self._lock:
+                self._in_flight -= 1
+                self._latency_ms += self.LATENCY_SMOOTHING * (elapsed_ms - self._latency_ms)
+
+    def stats(self):
+        """Snapshot of current load and drop counters."""
+        with self._lock:
+            return {
+                'overloaded': self.is_overloaded(),
+                'in_flight': self._in_flight,
+                'avg_latency_ms': round(self._latency_ms, 1),
+                'tracked_ips': len(self._ip_buckets),
+                'dropped': dict(self.dropped),
+            }
+
+
+pixel_shedder = PixelLoadShedder()
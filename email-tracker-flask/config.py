@@ -13,6 +13,28 @@ if dotenv_path.exists():
 else:
     logger.warning(f".env file not found at {dotenv_path}, using defaults or existing environment variables.")
 
+def _float_env(name, default):
+    """Reads a float setting from the environment, falling back to default if invalid."""
+    value = os.getenv(name)
+    if value is None:
+        return float(default)
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        logger.error(f"Invalid {name} value '{value}'. Using default {default}.")
+        return float(default)
+
+def _int_env(name, default):
+    """Reads an integer setting from the environment, falling back to default if invalid."""
+    value = os.getenv(name)
+    if value is None:
+        return int(default)
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        logger.error(f"Invalid {name} value '{value}'. Using default {default}.")
+        return int(default)
+
 class Config:
     """Base configuration settings."""
     SECRET_KEY = os.environ.get('SECRET_KEY', 'default_secret_key_if_not_set')
@@ -63,6 +85,22 @@ class Config:
     GEOIP_DATABASE_PATH = os.environ.get('GEOIP_DATABASE_PATH', str(basedir / 'geoip_data' / 'GeoLite2-City.mmdb'))
     if not os.path.exists(GEOIP_DATABASE_PATH):
         logger.warning(f"GeoIP database file not found at configured path: {GEOIP_DATABASE_PATH}")
+    # Seconds between checks for a replaced .mmdb file (hot reload)
+    GEOIP_RELOAD_INTERVAL = _float_env('GEOIP_RELOAD_INTERVAL', 60)
+
+    # Number of trusted reverse proxies setting X-Forwarded-For (0 = app is exposed directly).
+    # Per-IP pixel limits key on the address this yields, so it must match the real hop count.
+    PROXY_FIX_X_FOR = _int_env('PROXY_FIX_X_FOR', 0)
+
+    # Tracking pixel load shedding (limits are per worker process)
+    PIXEL_IP_RATE = _float_env('PIXEL_IP_RATE', 5) # Recorded opens per second per IP
+    PIXEL_IP_BURST = _float_env('PIXEL_IP_BURST', 50)
+    PIXEL_GLOBAL_RATE = _float_env('PIXEL_GLOBAL_RATE', 200) # Recorded opens per second overall
+    PIXEL_GLOBAL_BURST = _float_env('PIXEL_GLOBAL_BURST', 400)
+    PIXEL_MAX_IN_FLIGHT = _int_env('PIXEL_MAX_IN_FLIGHT', 2) # Other recordings in progress in this worker before overload (0 = off)
+    PIXEL_LATENCY_THRESHOLD_MS = _float_env('PIXEL_LATENCY_THRESHOLD_MS', 250) # Avg recording time before overload
+    PIXEL_OVERLOAD_SAMPLE_RATE = _float_env('PIXEL_OVERLOAD_SAMPLE_RATE', 0.1) # Fraction still recorded when overloaded
+    PIXEL_TRACKED_IPS = _int_env('PIXEL_TRACKED_IPS', 10000) # Max per-IP buckets kept in memory
 
 # Select the active configuration
 ActiveConfig = Config()